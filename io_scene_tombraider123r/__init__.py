@@ -14,17 +14,21 @@ bl_info = {
 
 if "bpy" in locals():
     from importlib import reload
+    if "trm_texcache" in locals():
+        reload(trm_texcache)
     if "trm_import" in locals():
         reload(trm_import)
     if "trm_export" in locals():
         reload(trm_export)
+    if "trm_catalog" in locals():
+        reload(trm_catalog)
     del reload
 
 
 import bpy, os
-from . import trm_import, trm_export
+from . import trm_texcache, trm_import, trm_export, trm_catalog
 from bpy.types import AddonPreferences, UILayout
-from bpy.props import StringProperty
+from bpy.props import StringProperty, IntProperty
 
 
 def absolutePath(key):
@@ -48,7 +52,8 @@ class PT_TRM_Preferences(AddonPreferences):
     game_path: StringProperty(
         name="Game Path",
         description='"Tomb Raider I-III Remastered" installation directory.\n'
-                    'Used to find & convert textures via the converter.\n'
+                    'Used to find & convert textures via the converter,\n'
+                    'and to list TRMs in the catalog panel.\n'
                     'Leave empty to look for folders relative to the TRMs being handled',
         subtype='DIR_PATH',
         update=lambda s, c: absolutePath('game_path'),
@@ -64,6 +69,23 @@ class PT_TRM_Preferences(AddonPreferences):
         default=""
     )
 
+    cache_path: StringProperty(
+        name="Texture Cache",
+        description='Directory to cache PNGs converted from DDS files, by file content.\n'
+                    'Changed DDS files are converted again.\n'
+                    'Leave empty to use "Converted PNGs" folders instead',
+        subtype='DIR_PATH',
+        update=lambda s, c: absolutePath('cache_path'),
+        default=""
+    )
+
+    cache_size: IntProperty(
+        name="Cache Size (MB)",
+        description='Least recently used PNGs are removed from texture cache over this size',
+        min=1,
+        default=2048
+    )
+
     def draw(self, context):
         layout = UILayout(self.layout)
         col = layout.column()
@@ -71,6 +93,8 @@ class PT_TRM_Preferences(AddonPreferences):
         col.prop(self, 'converter_path')
         col.prop(self, 'game_path')
         col.prop(self, 'png_path')
+        col.prop(self, 'cache_path')
+        col.prop(self, 'cache_size')
 
         col.separator()
         row = col.row()
@@ -83,8 +107,10 @@ def register():
     bpy.utils.register_class(PT_TRM_Preferences)
     trm_import.register()
     trm_export.register()
+    trm_catalog.register()
 
 def unregister():
+    trm_catalog.unregister()
     trm_export.unregister()
     trm_import.unregister()
     bpy.utils.unregister_class(PT_TRM_Preferences)
@@ -0,0 +1,228 @@
+# v0.5.1
+
+import bpy, json
+
+from struct import error
+from os import path, scandir, replace
+
+from bpy.props import BoolProperty, IntProperty, StringProperty, CollectionProperty
+from bpy.types import Operator, Panel, PropertyGroup, UIList
+
+from .trm_import import readHeader
+
+
+EPISODES = ('1', '2', '3')
+
+
+class TRMCatalogEntry(PropertyGroup):
+    filepath: StringProperty(subtype='FILE_PATH')
+    episode: StringProperty()
+    textures: StringProperty()
+    num_shaders: IntProperty()
+    num_textures: IntProperty()
+    num_joints: IntProperty()
+    num_indices: IntProperty()
+    num_vertices: IntProperty()
+    select: BoolProperty(name="Select", default=False)
+
+
+class ScanCatalogTRM(Operator):
+    """Scan all episodes in game path for TRM files.\nOnly new or changed files are read"""
+    bl_idname = "io_tombraider123r.catalog_scan"
+    bl_label = "Scan TRMs"
+
+    def execute(self, context):
+        prefs = context.preferences.addons[__package__].preferences
+        if not path.isdir(prefs.game_path):
+            self.report({'ERROR'}, "Game Path must be specified in Addon Preferences!")
+            return {'CANCELLED'}
+
+        files, read = scanCatalog(prefs.game_path)
+
+        entries = context.window_manager.trm_catalog
+        entries.clear()
+        for filepath in sorted(files):
+            info = files[filepath]
+            e = entries.add()
+            e.name = path.basename(filepath)
+            e.filepath = filepath
+            e.episode = info['episode']
+            e.textures = " ".join(str(t) for t in info['textures'])
+            e.num_shaders = info['shaders']
+            e.num_textures = len(info['textures'])
+            e.num_joints = info['joints']
+            e.num_indices = info['indices']
+            e.num_vertices = info['vertices']
+
+        self.report({'INFO'}, "%d TRMs, %d Read." % (len(files), read))
+        return {'FINISHED'}
+
+
+class ImportCatalogTRM(Operator):
+    """Import checked TRMs from catalog"""
+    bl_idname = "io_tombraider123r.catalog_import"
+    bl_label = "Import Checked"
+    bl_options = {'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return any(e.select for e in context.window_manager.trm_catalog)
+
+    def execute(self, context):
+        # importer takes one directory per call
+        directories = {}
+        for e in context.window_manager.trm_catalog:
+            if e.select:
+                directories.setdefault(path.dirname(e.filepath), []).append({'name': path.basename(e.filepath)})
+
+        use_tex = context.window_manager.trm_catalog_use_tex
+        for directory, files in directories.items():
+            bpy.ops.io_tombraider123r.trm_import(directory=directory, files=files, use_tex=use_tex)
+
+        return {'FINISHED'}
+
+
+class TRM_UL_Catalog(UIList):
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
+        row = layout.row(align=True)
+        row.prop(item, 'select', text="")
+        row.label(text="%s/%s" % (item.episode, item.name))
+        row.label(text="%d V, %d S, %d J" % (item.num_vertices, item.num_shaders, item.num_joints))
+
+    # search by file name or texture ID
+    def filter_items(self, context, data, propname):
+        items = getattr(data, propname)
+        search = self.filter_name.upper()
+        flags = []
+        for e in items:
+            if not search or search in e.name.upper() or search in e.textures.split():
+                flags.append(self.bitflag_filter_item)
+            else:
+                flags.append(0)
+        return flags, []
+
+
+class VIEW3D_PT_TRM_Catalog(Panel):
+    bl_label = "TRM Catalog"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = "TRM"
+
+    def draw(self, context):
+        layout = self.layout
+        wm = context.window_manager
+
+        layout.operator(ScanCatalogTRM.bl_idname, icon='FILE_REFRESH')
+        layout.template_list("TRM_UL_Catalog", "", wm, 'trm_catalog', wm, 'trm_catalog_index')
+
+        entries = wm.trm_catalog
+        if 0 <= wm.trm_catalog_index < len(entries):
+            e = entries[wm.trm_catalog_index]
+            col = layout.column(align=True)
+            col.label(text="%d Indices, %d Vertices" % (e.num_indices, e.num_vertices))
+            col.label(text="%d Shaders, %d Joints" % (e.num_shaders, e.num_joints))
+            col.label(text="Textures: %s" % e.textures)
+
+        layout.prop(wm, 'trm_catalog_use_tex')
+        layout.operator(ImportCatalogTRM.bl_idname, icon='IMPORT')
+
+
+def catalogPath():
+    folder = bpy.utils.user_resource('CONFIG', path=__package__, create=True)
+    return path.join(folder, "trm_catalog.json")
+
+
+# returns {filepath: info} of all TRMs in game path & number of files actually read
+# files with unchanged modification time & size are taken from saved catalog
+def scanCatalog(game_path):
+    filepath = catalogPath()
+    saved = {}
+    if path.isfile(filepath):
+        try:
+            with open(filepath, 'r') as f:
+                saved = json.load(f)
+        except ValueError:
+            saved = {}
+
+    files = {}
+    read = 0
+    for episode in EPISODES:
+        folder = path.join(game_path, episode)
+        if not path.isdir(folder):
+            continue
+        for entry in scanTRMs(folder):
+            stat = entry.stat()
+            old = saved.get(entry.path)
+            if old and old['mtime'] == stat.st_mtime and old['size'] == stat.st_size:
+                files[entry.path] = old
+                continue
+            try:
+                info = readInfo(entry.path)
+            except (OSError, error):
+                info = None
+            if not info:
+                print("ERROR: Could not read %s" % entry.path)
+                continue
+            info['episode'] = episode
+            info['mtime'] = stat.st_mtime
+            info['size'] = stat.st_size
+            files[entry.path] = info
+            read += 1
+
+    # write to a temporary file first so an interrupted save keeps the old catalog
+    with open(filepath + ".tmp", 'w') as f:
+        json.dump(files, f)
+    replace(filepath + ".tmp", filepath)
+
+    return files, read
+
+
+def scanTRMs(folder):
+    for entry in scandir(folder):
+        if entry.is_dir():
+            yield from scanTRMs(entry.path)
+        elif entry.name.upper().endswith(".TRM"):
+            yield entry
+
+
+def readInfo(filepath):
+    with open(filepath, 'rb') as f:
+        header = readHeader(f, read_shaders=False)
+
+    if not header:
+        return None
+
+    return {
+        'shaders': header['num_shaders'],
+        'textures': list(header['textures']),
+        'joints': header['num_joints'],
+        'indices': header['num_indices'],
+        'vertices': header['num_vertices']
+    }
+
+
+classes = (
+    TRMCatalogEntry,
+    ScanCatalogTRM,
+    ImportCatalogTRM,
+    TRM_UL_Catalog,
+    VIEW3D_PT_TRM_Catalog,
+)
+
+def register():
+    for c in classes:
+        bpy.utils.register_class(c)
+    bpy.types.WindowManager.trm_catalog = CollectionProperty(type=TRMCatalogEntry)
+    bpy.types.WindowManager.trm_catalog_index = IntProperty()
+    bpy.types.WindowManager.trm_catalog_use_tex = BoolProperty(
+        name="Use Textures",
+        description="Convert DDS textures to PNG, import and apply to mesh",
+        default=False
+    )
+
+def unregister():
+    del bpy.types.WindowManager.trm_catalog_use_tex
+    del bpy.types.WindowManager.trm_catalog_index
+    del bpy.types.WindowManager.trm_catalog
+    for c in reversed(classes):
+        bpy.utils.unregister_class(c)
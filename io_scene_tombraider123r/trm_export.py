@@ -1,13 +1,17 @@
 # v0.5.1
 
 import bpy, bmesh
+import numpy as np
 
-from struct import pack
-from math import sqrt
+from struct import pack, unpack
+from math import sqrt, cos, floor, radians
 from gc import collect
+from os import path
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 
 from bpy_extras.io_utils import ExportHelper
-from bpy.props import BoolProperty, FloatProperty, StringProperty
+from bpy.props import BoolProperty, FloatProperty, IntProperty, StringProperty, EnumProperty
 from bpy.types import Operator
 
 
@@ -48,10 +52,91 @@ class ExportTRM(Operator, ExportHelper):
         default=False,
     )
 
+    merge_shaders: BoolProperty(
+        name="Merge Shaders",
+        description="Merge shaders of the same type with matching colors into one shader.\n"
+                    "Each shader costs the game a draw call",
+        default=False,
+    )
+
+    shader_tolerance: IntProperty(
+        name="Color Tolerance",
+        description="Maximum difference per color channel (0-255) for shaders to be merged",
+        min=0,
+        max=255,
+        default=1,
+    )
+
+    weld: BoolProperty(
+        name="Weld Vertices",
+        description="Merge vertices that are nearly identical within the tolerances below.\n"
+                    "Shrinks vertex count, slightly moves welded corners",
+        default=False,
+    )
+
+    weld_distance: FloatProperty(
+        name="Distance",
+        description="Maximum distance between welded vertices",
+        min=0.000001,
+        default=0.0001,
+        precision=6,
+        subtype='DISTANCE',
+    )
+
+    weld_angle: FloatProperty(
+        name="Normal Angle",
+        description="Maximum angle in degrees between welded vertex normals",
+        min=0.0,
+        max=180.0,
+        default=2.0,
+    )
+
+    weld_uv: FloatProperty(
+        name="UV",
+        description="Maximum UV difference between welded vertices",
+        min=0.0,
+        max=1.0,
+        default=0.002,
+        precision=4,
+    )
+
+    weld_weight: FloatProperty(
+        name="Weight",
+        description="Maximum joint weight difference between welded vertices",
+        min=0.0,
+        max=1.0,
+        default=0.01,
+        precision=3,
+    )
+
+    shader_data: BoolProperty(
+        name="Use Imported Shaders",
+        description="Use shader values stored on imported materials instead of reading node colors.\n"
+                    "Ignored for renamed materials or edited colors",
+        default=True,
+    )
+
+    select_invalid: BoolProperty(
+        name="Select Invalid",
+        description="Select vertices that fail validation.\n"
+                    "Not available when applying modifiers",
+        default=True,
+    )
+
+    batch: EnumProperty(
+        name="Batch",
+        description="Write several TRMs, named after objects or collections, into the chosen folder",
+        items=(
+            ('NONE', "Single File", "Export all objects into chosen file"),
+            ('OBJECT', "Per Object", "One TRM per object"),
+            ('COLLECTION', "Per Collection", "One TRM per collection of selected objects"),
+        ),
+        default='NONE',
+    )
+
     def execute(self, context):
         print("\nEXPORTING...")
 
-        trm_data = {'shaders': {}, 'textures': [], 'indices': [], 'vertices': []}
         objects = []
 
         # SELECT ACTIVE OBJECT(s) & PROCESS
@@ -64,25 +149,19 @@ class ExportTRM(Operator, ExportHelper):
                 if obj.type == 'MESH':
                     objects.append(obj)
 
-        if len(objects) > 0:
-            for obj in objects:
-                print("- %s -" % obj.name)
-                trm_mesh = obj.data.copy()
-                if self.apply_modifiers:
-                    applyModifiers(trm_mesh, obj)
-                triangulateMesh(trm_mesh)
-                if self.apply_transforms:
-                    processTRM(trm_mesh, trm_data, self.scale, obj.matrix_world)
-                else:
-                    processTRM(trm_mesh, trm_data, self.scale, False)
-                bpy.data.meshes.remove(trm_mesh)
-                del trm_mesh
-                collect()
-        else:
+        if len(objects) == 0:
             if self.act_only:
-                trm_data['CANCELLED'] = "Active object must be a 3D Object!"
+                error = "Active object must be a 3D Object!"
             else:
-                trm_data['CANCELLED'] = "Select one or more 3D Objects!"
+                error = "Select one or more 3D Objects!"
+            print("ERROR: "+error+"\nCANCELLED!")
+            self.report({'ERROR'}, error)
+            return {'CANCELLED'}
+
+        if self.batch != 'NONE':
+            return self.exportBatch(objects)
+
+        trm_data = self.exportObjects(objects, {})
 
         if 'CANCELLED' in trm_data:
             print("ERROR: "+trm_data['CANCELLED']+"\nCANCELLED!")
@@ -92,15 +171,135 @@ class ExportTRM(Operator, ExportHelper):
             writeTRM(trm_data, self.filepath)
             print("%d Shaders, %d Textures, %d Indices, %d Vertices" % (len(trm_data['shaders']), len(trm_data['textures']), len(trm_data['indices']), len(trm_data['vertices'])))
             print("DONE!")
-            self.report({'INFO'}, "Export Completed.")
+            self.report({'INFO'}, "Export Completed." + trm_data['message'])
+
+        return {'FINISHED'}
+
+    # one TRM per object or collection, written next to the chosen file path
+    # packing needs Blender data so it stays on main thread, writing runs in parallel
+    def exportBatch(self, objects):
+        groups = {}
+        if self.batch == 'OBJECT':
+            for obj in objects:
+                groups[obj.name] = [obj]
+        else:
+            for obj in objects:
+                for coll in obj.users_collection:
+                    groups.setdefault(coll.name, []).append(obj)
+
+        directory = path.dirname(self.filepath)
+        materials = {}
+        filenames = {}
+        timings = []
+        completed = 0
+        failed = 0
+
+        with ThreadPoolExecutor() as pool:
+            for name, group in groups.items():
+                # file names are case insensitive on Windows
+                filename = bpy.path.clean_name(name) + self.filename_ext
+                print("\n%s" % filename)
+                if filename.upper() in filenames:
+                    print("ERROR: Same file name as %s!\nCANCELLED!" % filenames[filename.upper()])
+                    failed += 1
+                    continue
+                filenames[filename.upper()] = name
+
+                start = perf_counter()
+                trm_data = self.exportObjects(group, materials)
+                packed = perf_counter() - start
+                if 'CANCELLED' in trm_data:
+                    print("ERROR: "+trm_data['CANCELLED']+"\nCANCELLED!")
+                    failed += 1
+                    continue
+                filepath = path.join(directory, filename)
+                timings.append((filename, trm_data, packed, pool.submit(timedWrite, trm_data, filepath)))
+
+        print("\nBATCH SUMMARY:")
+        for filename, trm_data, packed, written in timings:
+            try:
+                seconds = written.result()
+            except OSError as e:
+                print("%s: ERROR: %s" % (filename, e))
+                failed += 1
+                continue
+            print("%s: %d Shaders, %d Vertices, %.3fs Packing, %.3fs Writing" % (filename, len(trm_data['shaders']), len(trm_data['vertices']), packed, seconds))
+            completed += 1
+        print("DONE!")
+
+        if failed != 0:
+            self.report({'ERROR'}, "%d Failed, %d Completed Export(s)!" % (failed, completed))
+        else:
+            self.report({'INFO'}, "%d Completed Export(s)." % completed)
 
         return {'FINISHED'}
 
+    # validate & pack objects into a new TRM data
+    # materials is shared between exports, so each material is only read once
+    def exportObjects(self, objects, materials):
+        trm_data = {'shaders': {}, 'textures': [], 'indices': [], 'vertices': [], 'lookup': {}, 'materials': materials, 'shader_data': self.shader_data, 'message': ""}
+
+        if self.weld:
+            trm_data['weld'] = {
+                'distance': self.weld_distance,
+                'normal': cos(radians(self.weld_angle)),
+                'uv': self.weld_uv,
+                'weight': self.weld_weight,
+                'cells': {},
+                'exact': set()
+            }
+
+        meshes = []
+        for obj in objects:
+            trm_mesh = obj.data.copy()
+            if self.apply_modifiers:
+                applyModifiers(trm_mesh, obj)
+            triangulateMesh(trm_mesh)
+            meshes.append(trm_mesh)
+
+        # VALIDATE ALL MESHES BEFORE PACKING
+        select = self.select_invalid and not self.apply_modifiers
+        errors = validateMeshes(objects, meshes, select)
+        if errors:
+            trm_data['CANCELLED'] = errors
+        else:
+            for obj, trm_mesh in zip(objects, meshes):
+                print("- %s -" % obj.name)
+                if self.apply_transforms:
+                    processTRM(trm_mesh, trm_data, self.scale, obj.matrix_world)
+                else:
+                    processTRM(trm_mesh, trm_data, self.scale, False)
+            if len(trm_data['vertices']) > MAX_VERTICES:
+                trm_data['CANCELLED'] = "%d Vertices, Maximum %d Allowed!" % (len(trm_data['vertices']), MAX_VERTICES)
+
+        for trm_mesh in meshes:
+            bpy.data.meshes.remove(trm_mesh)
+        del meshes
+        collect()
+
+        if 'CANCELLED' in trm_data:
+            return trm_data
+
+        if self.merge_shaders:
+            merged, dropped = mergeShaders(trm_data, self.shader_tolerance)
+            print("%d Shaders Merged, %d Unused Shaders Dropped" % (merged, dropped))
+            trm_data['message'] += " %d Shader(s) Saved by Merging, %d Unused Dropped." % (merged, dropped)
+        if self.weld:
+            before = len(trm_data['weld']['exact'])
+            after = len(trm_data['vertices'])
+            print("%d Vertices Before Welding, %d After" % (before, after))
+            trm_data['message'] += " %d -> %d Vertices by Welding." % (before, after)
+
+        return trm_data
+
 
 def processTRM(mesh, data, scale, matrix):
     shaders = data['shaders']
     textures = data['textures']
     vertices = data['vertices']
+    lookup = data['lookup']
+    materials = data['materials']
+    weld = data.get('weld')
 
     # SHADERS & TEXTURES from MATERIALS
     # material_map will be used to refer to shader & texture arrays from polygon.material_index
@@ -109,17 +308,12 @@ def processTRM(mesh, data, scale, matrix):
 
     for mat in mesh.materials:
         mark = ['0_0_0_0_0', 'indicesA', 0]
-        # expected material name "[textureID]_[shaderTYPE]_[A,B or C]_Mat"
-        ids = mat.name.split("_")
-        tex = 8000
-        shd = 0
-        if ids[0].isnumeric():
-            tex = int(ids[0])
-        if len(ids)>1 and ids[1].isnumeric():
-            shd = int(ids[1])
-        if len(ids)>2:
-            if ids[2] == 'B': mark[1] = 'indicesB'
-            if ids[2] == 'C': mark[1] = 'indicesC'
+        if mat.name not in materials:
+            stored = storedShader(mat) if data.get('shader_data') else None
+            materials[mat.name] = stored or readShader(mat)
+        tex, sub, shd, shd1, shd2, shd3, shd4 = materials[mat.name]
+        if sub == 'B': mark[1] = 'indicesB'
+        if sub == 'C': mark[1] = 'indicesC'
 
         if tex in textures:
             mark[2] = textures.index(tex)
@@ -127,19 +321,9 @@ def processTRM(mesh, data, scale, matrix):
             mark[2] = len(textures)
             textures.append(tex)
 
-        if 'Group' in mat.node_tree.nodes.keys():
-            shd1 = rgba2int(mat.node_tree.nodes['Group'].inputs['Color1'].default_value)
-            shd2 = rgba2int(mat.node_tree.nodes['Group'].inputs['Color2'].default_value)
-            shd3 = rgba2int(mat.node_tree.nodes['Group'].inputs['Color3'].default_value)
-            shd4 = rgba2int(mat.node_tree.nodes['Group'].inputs['Color4'].default_value)
-        else:
-            shd1 = 0
-            shd2 = 0
-            shd3 = 0
-            shd4 = 0
         skey = "%d_%d_%d_%d_%d" % (shd, shd1, shd2, shd3, shd4)
         if skey not in shaders:
-            shaders[skey] = {'pack': pack("<5I", shd, shd1, shd2, shd3, shd4), 'indicesA': [], 'indicesB': [], 'indicesC': []}
+            shaders[skey] = {'pack': pack("<5I", shd, shd1, shd2, shd3, shd4), 'values': (shd, shd1, shd2, shd3, shd4), 'indicesA': [], 'indicesB': [], 'indicesC': []}
         mark[0] = skey
         material_map.append(mark)
 
@@ -153,13 +337,7 @@ def processTRM(mesh, data, scale, matrix):
         for i in v_order:
             loop = mesh.loops[p.loop_indices[i]]
             groups = mesh.vertices[loop.vertex_index].groups
-            if len(groups) > 3:
-                data['CANCELLED'] = "Maximum 3 Joints Allowed per Vertex!"
-                return
             uv = uvs.data[p.loop_indices[i]].uv
-            if uv[0] < 0 or uv[0] > 1.0 or uv[1] < 0 or uv[1] > 1.0:
-                data['CANCELLED'] = "UV Out of Bounds!"
-                return
             coords = mesh.vertices[loop.vertex_index].co
             if matrix:
                 coords = matrix @ coords
@@ -172,14 +350,210 @@ def processTRM(mesh, data, scale, matrix):
                 uv
             )
             indices = shaders[mark[0]][mark[1]]
-            if vertex in vertices:
-                indices.append(vertices.index(vertex))
+            if weld:
+                weld['exact'].add(vertex)
+                corner = weldCorner(coords, loop.normal, mark[2], groups, uv)
+                welded = findWeld(weld, corner)
+                if welded is not None:
+                    indices.append(welded)
+                    continue
+            if vertex in lookup:
+                indices.append(lookup[vertex])
             else:
+                if weld:
+                    addWeld(weld, corner, num_vertices)
+                lookup[vertex] = num_vertices
                 indices.append(num_vertices)
                 vertices.append(vertex)
                 num_vertices += 1
 
 
+# VALIDATION
+# indices are written as 16-bit, so vertex count is limited
+# only known after packing, identical vertices get merged within & across meshes
+MAX_VERTICES = 0x10000
+MAX_JOINTS = 3
+
+# checks all meshes at once, returns error message or empty string
+# every offending vertex is listed in console & optionally selected in the source object
+def validateMeshes(objects, meshes, select):
+    errors = []
+
+    for obj, mesh in zip(objects, meshes):
+        num_vertices = len(mesh.vertices)
+        num_loops = len(mesh.loops)
+
+        if len(mesh.materials) == 0 or None in mesh.materials[:]:
+            errors.append("%s: Missing Material(s)!" % obj.name)
+
+        loop_vertices = np.empty(num_loops, dtype=np.int32)
+        mesh.loops.foreach_get('vertex_index', loop_vertices)
+        used = np.unique(loop_vertices)
+
+        # joints per vertex, vertex groups can't be read as an array
+        num_groups = np.fromiter((len(v.groups) for v in mesh.vertices), dtype=np.int32, count=num_vertices)
+        bad_joints = used[num_groups[used] > MAX_JOINTS]
+
+        # UVs
+        if mesh.uv_layers.active:
+            uvs = np.empty(num_loops * 2, dtype=np.float32)
+            mesh.uv_layers.active.data.foreach_get('uv', uvs)
+            bad_loops = ((uvs < 0.0) | (uvs > 1.0)).reshape(-1, 2).any(axis=1)
+            bad_uvs = np.unique(loop_vertices[bad_loops])
+        else:
+            errors.append("%s: No UV Map!" % obj.name)
+            bad_uvs = np.empty(0, dtype=np.int32)
+
+        if bad_joints.size:
+            errors.append("%s: %d Vertices with over %d Joints!" % (obj.name, bad_joints.size, MAX_JOINTS))
+            print("- %s: Over %d Joints: %s" % (obj.name, MAX_JOINTS, bad_joints.tolist()))
+        if bad_uvs.size:
+            errors.append("%s: %d Vertices with UV Out of Bounds!" % (obj.name, bad_uvs.size))
+            print("- %s: UV Out of Bounds: %s" % (obj.name, bad_uvs.tolist()))
+
+        if select and (bad_joints.size or bad_uvs.size) and len(obj.data.vertices) == num_vertices:
+            selectVertices(obj.data, np.union1d(bad_joints, bad_uvs))
+
+    return " ".join(errors)
+
+
+def selectVertices(mesh, indices):
+    mask = np.zeros(len(mesh.vertices), dtype=bool)
+    mask[indices] = True
+    mesh.vertices.foreach_set('select', mask)
+    mesh.edges.foreach_set('select', np.zeros(len(mesh.edges), dtype=bool))
+    mesh.polygons.foreach_set('select', np.zeros(len(mesh.polygons), dtype=bool))
+    mesh.update()
+
+
+# VERTEX WELDING
+# corners are hashed into cells the size of the distance tolerance,
+# a corner only needs to be compared against vertices in its own & neighbouring cells
+def weldCorner(coords, normal, texture, groups, uv):
+    return {
+        'co': (coords[0], coords[1], coords[2]),
+        'normal': (normal[0], normal[1], normal[2]),
+        'tex': texture,
+        'groups': sorted((g.group, g.weight) for g in groups),
+        'uv': (uv[0], uv[1])
+    }
+
+
+def weldCell(weld, co):
+    d = weld['distance']
+    return (floor(co[0] / d), floor(co[1] / d), floor(co[2] / d))
+
+
+def addWeld(weld, corner, index):
+    corner['index'] = index
+    weld['cells'].setdefault(weldCell(weld, corner['co']), []).append(corner)
+
+
+def findWeld(weld, corner):
+    cells = weld['cells']
+    cx, cy, cz = weldCell(weld, corner['co'])
+    for x in (cx - 1, cx, cx + 1):
+        for y in (cy - 1, cy, cy + 1):
+            for z in (cz - 1, cz, cz + 1):
+                for other in cells.get((x, y, z), ()):
+                    if similarCorners(weld, corner, other):
+                        return other['index']
+    return None
+
+
+def similarCorners(weld, a, b):
+    if a['tex'] != b['tex'] or len(a['groups']) != len(b['groups']):
+        return False
+    d = weld['distance']
+    if sum((a['co'][n] - b['co'][n]) ** 2 for n in range(3)) > d * d:
+        return False
+    if sum(a['normal'][n] * b['normal'][n] for n in range(3)) < weld['normal']:
+        return False
+    if abs(a['uv'][0] - b['uv'][0]) > weld['uv'] or abs(a['uv'][1] - b['uv'][1]) > weld['uv']:
+        return False
+    for ga, gb in zip(a['groups'], b['groups']):
+        if ga[0] != gb[0] or abs(ga[1] - gb[1]) > weld['weight']:
+            return False
+    return True
+
+
+# shader values stored on the material by importer
+# importer removes them once colors are edited, so they're trusted while the name is unchanged
+def storedShader(mat):
+    if 'trm_shader' not in mat or mat.get('trm_name') != mat.name:
+        return None
+    shd = unpack("<5I", pack("<5i", *mat['trm_shader']))
+    return (mat['trm_texture'], mat['trm_sub'], *shd)
+
+
+def readShader(mat):
+    # expected material name "[textureID]_[shaderTYPE]_[A,B or C]_Mat"
+    ids = mat.name.split("_")
+    tex = 8000
+    sub = 'A'
+    shd = 0
+    if ids[0].isnumeric():
+        tex = int(ids[0])
+    if len(ids)>1 and ids[1].isnumeric():
+        shd = int(ids[1])
+    if len(ids)>2:
+        sub = ids[2]
+
+    if 'Group' in mat.node_tree.nodes.keys():
+        shd1 = rgba2int(mat.node_tree.nodes['Group'].inputs['Color1'].default_value)
+        shd2 = rgba2int(mat.node_tree.nodes['Group'].inputs['Color2'].default_value)
+        shd3 = rgba2int(mat.node_tree.nodes['Group'].inputs['Color3'].default_value)
+        shd4 = rgba2int(mat.node_tree.nodes['Group'].inputs['Color4'].default_value)
+    else:
+        shd1 = 0
+        shd2 = 0
+        shd3 = 0
+        shd4 = 0
+
+    return (tex, sub, shd, shd1, shd2, shd3, shd4)
+
+
+# merge shaders of the same type with close colors & drop unused ones
+# returns number of shaders merged into others & number of unused ones dropped
+def mergeShaders(data, tolerance):
+    shaders = data['shaders']
+    merged = {}
+    dropped = 0
+
+    for skey, shd in shaders.items():
+        if not (shd['indicesA'] or shd['indicesB'] or shd['indicesC']):
+            dropped += 1
+            continue
+        for mshd in merged.values():
+            if similarShaders(shd['values'], mshd['values'], tolerance):
+                mshd['indicesA'].extend(shd['indicesA'])
+                mshd['indicesB'].extend(shd['indicesB'])
+                mshd['indicesC'].extend(shd['indicesC'])
+                break
+        else:
+            merged[skey] = shd
+
+    data['shaders'] = merged
+    return len(shaders) - len(merged) - dropped, dropped
+
+
+def similarShaders(a, b, tolerance):
+    if a[0] != b[0]:
+        return False
+    for n in range(1, 5):
+        for shift in (0, 8, 16, 24):
+            if abs(((a[n] >> shift) & 0xff) - ((b[n] >> shift) & 0xff)) > tolerance:
+                return False
+    return True
+
+
+# returns seconds spent writing
+def timedWrite(data, filepath):
+    start = perf_counter()
+    writeTRM(data, filepath)
+    return perf_counter() - start
+
+
 def writeTRM(data, filepath):
     f = open(filepath, 'wb')
 
@@ -1,16 +1,28 @@
 # v0.5.0
 
 import bpy, bmesh
+import numpy as np
 
-from struct import unpack
+from struct import pack, unpack
 from math import sqrt
 from gc import collect
 from os import path, mkdir
 from subprocess import run
+from time import perf_counter
+from traceback import print_exc
 
 from bpy_extras.io_utils import ImportHelper
 from bpy.props import BoolProperty, FloatProperty, StringProperty, EnumProperty, CollectionProperty
 from bpy.types import Operator, OperatorFileListElement
+from bpy.app.handlers import persistent
+
+from . import trm_texcache
+
+
+# seconds of work per timer tick during background import
+TIME_BUDGET = 0.1
+# vertices or polygons processed between background import pauses
+STEP_SIZE = 5000
 
 
 class ImportTRM(Operator, ImportHelper):
@@ -78,6 +90,32 @@ class ImportTRM(Operator, ImportHelper):
         default='1',
     )
 
+    preview: BoolProperty(
+        name="Preview",
+        description="Only import positions & triangles for quick browsing.\n"
+                    "Use Object > Finalize TRM Preview to build the rest with the options above",
+        default=False
+    )
+
+    mesh_reuse: EnumProperty(
+        name="Repeat Imports",
+        description="Mesh to use when a file is imported again with the same options.\n"
+                    "An untouched copy of each import is kept in the blend file to reuse",
+        items=(
+            ('NEW', "New Mesh", "Read the file & build a new mesh"),
+            ('COPY', "Copy Mesh", "Copy the mesh built by the first import"),
+            ('LINK', "Link Mesh", "Share one copy of the mesh built by the first import"),
+        ),
+        default='NEW',
+    )
+
+    background: BoolProperty(
+        name="Background Import",
+        description="Import step by step without freezing the interface.\n"
+                    "Press Esc to stop, objects imported so far are kept",
+        default=False
+    )
+
     def draw(self, context):
         layout = self.layout
         layout.use_property_split = True
@@ -91,105 +129,456 @@ class ImportTRM(Operator, ImportHelper):
         if self.use_tex:
             layout.prop(self, 'episode_dir')
 
+        layout.prop(self, 'preview')
+        if not self.preview:
+            layout.prop(self, 'mesh_reuse')
+        layout.prop(self, 'background')
+
     def execute(self, context):
-        # PROCESS FILES
-        completed = 0
-        cancelled = 0
-        for f in self.files:
+        self.completed = 0
+        self.cancelled = 0
+        self.pending = None
+        self.steps = self.importFiles(context)
+
+        if not self.background:
+            for progress in self.steps:
+                pass
+            return self.finish(context, False)
+
+        wm = context.window_manager
+        wm.progress_begin(0, len(self.files))
+        self.timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            print("STOPPED!")
+            return self.finish(context, True)
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        # run import steps until this tick's time budget is used up
+        start = perf_counter()
+        try:
+            while perf_counter() - start < TIME_BUDGET:
+                context.window_manager.progress_update(next(self.steps))
+        except StopIteration:
+            return self.finish(context, False)
+        except Exception as e:
+            # a failing stage must not leave timer, progress or half built object behind
+            print_exc()
+            self.cancelled += 1
+            self.report({'ERROR'}, "Import Failed: %s" % e)
+            return self.finish(context, True)
+
+        return {'RUNNING_MODAL'}
+
+    def finish(self, context, stopped):
+        self.steps.close()
+
+        # object stopped halfway through its import
+        if self.pending:
+            removeObject(self.pending)
+            self.pending = None
+
+        if self.background:
+            context.window_manager.event_timer_remove(self.timer)
+            context.window_manager.progress_end()
+
+        # stopped imports still finish so objects imported so far stay & get an undo step
+        if stopped:
+            self.report({'WARNING'}, "Stopped, %d Failed, %d Completed Import(s)." % (self.cancelled, self.completed))
+        elif self.cancelled != 0:
+            self.report({'ERROR'}, "%d Failed, %d Completed Import(s)!" % (self.cancelled, self.completed))
+        else:
+            self.report({'INFO'}, "%d Completed Import(s)." % self.completed)
+
+        return {'FINISHED'}
+
+    # PROCESS FILES
+    # yields progress between import stages, so background imports can pause
+    def importFiles(self, context):
+        for n, f in enumerate(self.files):
             print("\nIMPORTING:", f.name)
 
-            trm_data = readTRM(path.join(self.directory, f.name))
-            if trm_data == False:
-                cancelled += 1
-                print("CANCELLED!")
+            filepath = path.join(self.directory, f.name)
+            trm_name = str(f.name).removesuffix(self.filename_ext)
+
+            if self.preview:
+                trm_data = readTRM(filepath, raw=True)
+                if trm_data == False:
+                    self.cancelled += 1
+                    print("CANCELLED!")
+                    continue
+                trm_object = processPreview(trm_data, trm_name, self.scale)
+                trm_object['trm_source'] = path.abspath(filepath)
+                trm_object['trm_preview'] = {
+                    'scale': self.scale,
+                    'merge_uv': self.merge_uv,
+                    'armature_type': self.armature_type,
+                    'use_tex': self.use_tex,
+                    'episode_dir': self.episode_dir
+                }
+                context.collection.objects.link(trm_object)
+                self.completed += 1
+                print("PREVIEW DONE.")
+                del trm_data
+                yield n + 1
                 continue
 
-            trm_name = str(f.name).removesuffix(self.filename_ext)
-            trm_object = processTRM(trm_data, trm_name, self.scale)
+            key = meshKey(filepath, self.scale, self.merge_uv, self.armature_type)
+
+            trm_object = None
+            if self.mesh_reuse != 'NEW':
+                trm_object = reuseMesh(key, trm_name, self.mesh_reuse == 'COPY')
+
+            if trm_object:
+                self.pending = trm_object
+                print("Reusing Mesh:", trm_object.data.name)
+                textures = mesh_cache[key]['textures']
+            else:
+                trm_data = readTRM(filepath)
+                if trm_data == False:
+                    self.cancelled += 1
+                    print("CANCELLED!")
+                    continue
+                textures = trm_data['textures']
+                yield n + 0.1
+
+                trm_object = createTRM(trm_data, trm_name, self.scale)
+                self.pending = trm_object
+                yield n + 0.2
+
+                for progress in processTRMSteps(trm_object, trm_data):
+                    yield n + 0.2 + 0.3 * progress
+                del trm_data
 
-            if self.armature_type != 'ID':
-                nameVertexGroups(trm_object, self.armature_type, f.name)
+                if self.armature_type != 'ID':
+                    nameVertexGroups(trm_object, self.armature_type, f.name)
+                yield n + 0.5
 
-            if self.merge_uv:
-                mergeByUV(trm_object.data)
+                if self.merge_uv:
+                    mergeByUV(trm_object.data)
+                    yield n + 0.7
+
+                if self.mesh_reuse != 'NEW':
+                    cacheMesh(key, trm_object, textures)
 
             if self.use_tex:
-                processTextures(trm_object, trm_data['textures'], self.directory, self.episode_dir)
+                processTextures(trm_object, textures, self.directory, self.episode_dir)
+                yield n + 0.9
 
-            bpy.context.collection.objects.link(trm_object)
-            completed += 1
+            context.collection.objects.link(trm_object)
+            self.pending = None
+            self.completed += 1
             print("DONE.")
-            del trm_data
             collect()
+            yield n + 1
+
+
+# remove an unlinked object along with its mesh & materials if nothing else uses them
+def removeObject(trm):
+    mesh = trm.data
+    bpy.data.objects.remove(trm)
+    if mesh.users == 0:
+        materials = [m for m in mesh.materials if m]
+        bpy.data.meshes.remove(mesh)
+        for mat in materials:
+            if mat.users == 0:
+                bpy.data.materials.remove(mat)
+
+
+class FinalizeTRM(Operator):
+    """Build normals, joints, UVs, materials & textures of selected TRM previews"""
+    bl_idname = "io_tombraider123r.trm_finalize"
+    bl_label = "Finalize TRM Preview"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return any('trm_preview' in obj for obj in context.selected_objects)
+
+    def execute(self, context):
+        completed = 0
+        cancelled = 0
+        for obj in context.selected_objects:
+            if 'trm_preview' not in obj:
+                continue
+            if finalizePreview(obj):
+                completed += 1
+            else:
+                cancelled += 1
 
         if cancelled != 0:
-            self.report({'ERROR'}, "%d Failed, %d Completed Import(s)!" % (cancelled, completed))
+            self.report({'ERROR'}, "%d Failed, %d Finalized Preview(s)!" % (cancelled, completed))
         else:
-            self.report({'INFO'}, "%d Completed Import(s)." % completed)
+            self.report({'INFO'}, "%d Finalized Preview(s)." % completed)
 
         return {'FINISHED'}
 
 
-def readTRM(filepath):
-    data = {'shaders': [], 'textures': [], 'joints': [], 'indices': [], 'vertices': []}
-
-    f = open(filepath, 'rb')
+# reads everything before index & vertex buffers, None if not a TRM file
+# file is left at index buffer, shader records are skipped over unless read_shaders
+def readHeader(f, read_shaders=True):
+    header = {'shaders': [], 'num_unknown2': 0, 'num_unknown3': 0, 'num_unknown4': 0}
 
     # TRM\x02 marker
     if unpack('>I', f.read(4))[0] != 0x54524d02:
-        print("ERROR: Not a TRM file!")
-        f.close()
-        return False
+        return None
 
     # SHADERS
-    num_shaders = unpack('<I', f.read(4))[0]
-    for n in range(num_shaders):
-        shader = unpack("<11I", f.read(44))
-        data['shaders'].append(shader)
+    header['num_shaders'] = unpack('<I', f.read(4))[0]
+    if read_shaders:
+        for n in range(header['num_shaders']):
+            shader = unpack("<11I", f.read(44))
+            header['shaders'].append(shader)
+    else:
+        f.seek(header['num_shaders'] * 44, 1)
 
     # TEXTURES
     num_textures = unpack('<I', f.read(4))[0]
-    data['textures'] = unpack("<%dH" % num_textures, f.read(num_textures * 2))
+    header['textures'] = unpack("<%dH" % num_textures, f.read(num_textures * 2))
 
     # byte align
     if f.tell() % 4: f.seek(4 - (f.tell()%4), 1)
 
     # UNKNOWN ANIMATION DATA, SKIP OVER
-    num_joints = unpack('<I', f.read(4))[0]
-    if num_joints > 0:
-        f.seek(num_joints * 48, 1)
-        num_unknown2 = unpack('<I', f.read(4))[0]
-        f.seek(num_unknown2 * 8, 1)
-        num_unknown3 = unpack('<I', f.read(4))[0]
-        f.seek(num_unknown3 * 4, 1)
-        num_unknown4 = unpack('<H', f.read(2))[0]
-        num_unknown5 = unpack('<H', f.read(2))[0]
-        f.seek(num_unknown3 * num_unknown4 * 48, 1)
+    header['num_joints'] = unpack('<I', f.read(4))[0]
+    if header['num_joints'] > 0:
+        f.seek(header['num_joints'] * 48, 1)
+        header['num_unknown2'] = unpack('<I', f.read(4))[0]
+        f.seek(header['num_unknown2'] * 8, 1)
+        header['num_unknown3'] = unpack('<I', f.read(4))[0]
+        f.seek(header['num_unknown3'] * 4, 1)
+        header['num_unknown4'] = unpack('<H', f.read(2))[0]
+        f.seek(2, 1) # unknown5, unused
+        f.seek(header['num_unknown3'] * header['num_unknown4'] * 48, 1)
 
     # INDICES & VERTICES
-    num_indices = unpack('<I', f.read(4))[0]
-    num_vertices = unpack('<I', f.read(4))[0]
+    header['num_indices'] = unpack('<I', f.read(4))[0]
+    header['num_vertices'] = unpack('<I', f.read(4))[0]
+
+    return header
 
-    data['indices'] = unpack("<%dH" % num_indices, f.read(num_indices * 2))
+
+def readTRM(filepath, raw=False):
+    data = {'shaders': [], 'textures': [], 'joints': [], 'indices': [], 'vertices': []}
+
+    f = open(filepath, 'rb')
+
+    header = readHeader(f)
+    if not header:
+        print("ERROR: Not a TRM file!")
+        f.close()
+        return False
+
+    data['shaders'] = header['shaders']
+    data['textures'] = header['textures']
+    num_indices = header['num_indices']
+    num_vertices = header['num_vertices']
+
+    if raw:
+        data['indices'] = np.frombuffer(f.read(num_indices * 2), dtype='<u2')
+    else:
+        data['indices'] = unpack("<%dH" % num_indices, f.read(num_indices * 2))
 
     if f.tell() % 4: f.seek(4 - (f.tell()%4), 1)
 
-    for n in range(num_vertices):
-        vertex = unpack("<fff12B", f.read(24))
-        data['vertices'].append(vertex)
+    if raw:
+        data['vertices'] = np.frombuffer(f.read(num_vertices * 24), dtype=VERTEX_DTYPE)
+    else:
+        for n in range(num_vertices):
+            vertex = unpack("<fff12B", f.read(24))
+            data['vertices'].append(vertex)
 
     f.close()
 
-    print("%d Shaders, %d Textures, %d Indices, %d Vertices" % (num_shaders, num_textures, num_indices, num_vertices))
-    if num_joints > 0:
-        print("%d Joints, %d Unknown2, %d Unknown3, %d Unknown4" % (num_joints, num_unknown2, num_unknown3, num_unknown4))
+    print("%d Shaders, %d Textures, %d Indices, %d Vertices" % (header['num_shaders'], len(header['textures']), num_indices, num_vertices))
+    if header['num_joints'] > 0:
+        print("%d Joints, %d Unknown2, %d Unknown3, %d Unknown4" % (header['num_joints'], header['num_unknown2'], header['num_unknown3'], header['num_unknown4']))
 
     return data
 
 
+# raw vertex layout, same as "<fff12B"
+VERTEX_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('rest', 'u1', 12)])
+
+
+# positions & triangles only, straight from raw buffers
+def processPreview(data, name, scale):
+    vertices = data['vertices']
+    indices = data['indices']
+    num_faces = len(indices) // 3
+
+    coords = np.empty((len(vertices), 3), dtype=np.float32)
+    coords[:, 0] = -vertices['x'] * scale
+    coords[:, 1] = -vertices['z'] * scale
+    coords[:, 2] = -vertices['y'] * scale
+    faces = indices[:num_faces * 3].reshape(-1, 3)[:, [0, 2, 1]].astype(np.int32)
+
+    mesh = bpy.data.meshes.new(name+'_Mesh')
+    mesh.vertices.add(len(coords))
+    mesh.vertices.foreach_set('co', coords.ravel())
+    mesh.loops.add(num_faces * 3)
+    mesh.polygons.add(num_faces)
+    mesh.polygons.foreach_set('loop_start', np.arange(0, num_faces * 3, 3, dtype=np.int32))
+    mesh.polygons.foreach_set('vertices', faces.ravel())
+    mesh.update(calc_edges=True)
+    mesh.validate()
+
+    return bpy.data.objects.new(name, mesh)
+
+
+# replace preview mesh with a fully processed one, using options stored on import
+def finalizePreview(trm):
+    options = trm['trm_preview']
+    filepath = trm['trm_source']
+    filename = path.basename(filepath)
+    print("\nFINALIZING:", filename)
+
+    if not path.isfile(filepath):
+        print("ERROR: Source TRM not found: %s" % filepath)
+        print("CANCELLED!")
+        return False
+
+    trm_data = readTRM(filepath)
+    if trm_data == False:
+        print("CANCELLED!")
+        return False
+
+    full = processTRM(trm_data, trm.name, options['scale'])
+    if options['armature_type'] != 'ID':
+        nameVertexGroups(full, options['armature_type'], filename)
+    if options['merge_uv']:
+        mergeByUV(full.data)
+    if options['use_tex']:
+        processTextures(full, trm_data['textures'], path.dirname(filepath), options['episode_dir'])
+
+    preview = trm.data
+    trm.data = full.data
+    trm.vertex_groups.clear()
+    for g in full.vertex_groups:
+        trm.vertex_groups.new(name=g.name)
+    bpy.data.objects.remove(full)
+    if preview.users == 0:
+        bpy.data.meshes.remove(preview)
+
+    del trm['trm_preview']
+    print("DONE.")
+    return True
+
+
+# meshes of previous imports, (filepath, mtime, size, import options): mesh info
+# each import is kept as an untouched master mesh, hidden & with fake user,
+# tagged with its key so a mesh that took over its name is never mistaken for it
+mesh_cache = {}
+
+
+def meshKey(filepath, scale, merge_uv, armature_type):
+    filepath = path.abspath(filepath)
+    if not path.isfile(filepath):
+        return None
+    return (filepath, path.getmtime(filepath), path.getsize(filepath), scale, merge_uv, armature_type)
+
+
+def cacheMesh(key, trm, textures):
+    if not key:
+        return
+
+    master = trm.data.copy()
+    master.name = "." + trm.data.name
+    master.use_fake_user = True
+    master['trm_cache'] = {
+        'filepath': key[0],
+        'mtime': key[1],
+        'size': key[2],
+        'scale': key[3],
+        'merge_uv': key[4],
+        'armature_type': key[5],
+        'groups': "\n".join(g.name for g in trm.vertex_groups),
+        'textures': list(textures)
+    }
+    master['trm_cache_key'] = repr(key)
+
+    mesh_cache[key] = {
+        'mesh': master.name,
+        'linked': None,
+        'groups': [g.name for g in trm.vertex_groups],
+        'textures': textures
+    }
+
+
+def cachedMesh(key, name):
+    mesh = bpy.data.meshes.get(name) if name else None
+    if mesh and mesh.get('trm_cache_key') == repr(key):
+        return mesh
+    return None
+
+
+# new object using mesh from a previous import, None if there's none left
+# copies are made from the master, linked objects share one copy of it
+def reuseMesh(key, name, copy):
+    if key not in mesh_cache:
+        return None
+
+    entry = mesh_cache[key]
+    master = cachedMesh(key, entry['mesh'])
+    if not master:
+        del mesh_cache[key]
+        return None
+
+    if copy:
+        mesh = master.copy()
+        mesh.name = name + '_Mesh'
+        mesh.use_fake_user = False
+        del mesh['trm_cache']
+        del mesh['trm_cache_key']
+    else:
+        mesh = cachedMesh(key, entry['linked'])
+        if not mesh:
+            mesh = master.copy()
+            mesh.name = name + '_Mesh'
+            mesh.use_fake_user = False
+            del mesh['trm_cache']
+            entry['linked'] = mesh.name
+
+    trm = bpy.data.objects.new(name, mesh)
+    # vertex group names live in the object, weights in the mesh
+    for g in entry['groups']:
+        trm.vertex_groups.new(name=g)
+
+    return trm
+
+
+# rebuild cache from master meshes saved in a loaded file, drop outdated ones
+def loadMeshCache():
+    mesh_cache.clear()
+    for mesh in list(bpy.data.meshes):
+        if 'trm_cache' not in mesh:
+            continue
+        info = mesh['trm_cache']
+        key = meshKey(info['filepath'], info['scale'], bool(info['merge_uv']), info['armature_type'])
+        if not key or key[1] != info['mtime'] or key[2] != info['size']:
+            bpy.data.meshes.remove(mesh)
+            continue
+        mesh_cache[key] = {
+            'mesh': mesh.name,
+            'linked': None,
+            'groups': info['groups'].split("\n") if info['groups'] else [],
+            'textures': tuple(info['textures'])
+        }
+
+
 def processTRM(data, name, scale):
-    shaders = data['shaders']
-    textures = data['textures']
+    trm = createTRM(data, name, scale)
+    for progress in processTRMSteps(trm, data):
+        pass
+    return trm
+
+
+def createTRM(data, name, scale):
     indices = data['indices']
     vertices = data['vertices']
 
@@ -205,17 +594,31 @@ def processTRM(data, name, scale):
     mesh.from_pydata(verts, edges, faces, shade_flat=False)
     trm = bpy.data.objects.new(name, mesh)
 
+    return trm
+
+
+# fills in object from createTRM, yields progress from 0 to 1
+# between stages & every STEP_SIZE elements of the larger loops
+def processTRMSteps(trm, data):
+    shaders = data['shaders']
+    textures = data['textures']
+    vertices = data['vertices']
+    mesh = trm.data
+
     # NORMALS & VERTEX GROUPS
     normals = []
     max_group = 0
 
-    for v in vertices:
+    for n, v in enumerate(vertices):
         nr = normalByte2Float(v[3], v[4], v[5])
         normals.append((-nr[0], -nr[2], -nr[1]))
         max_group = max(v[7], v[8], v[9], max_group)
+        if n % STEP_SIZE == STEP_SIZE - 1:
+            yield 0.2 * n / len(vertices)
 
     mesh.use_auto_smooth = True
     mesh.normals_split_custom_set_from_vertices(normals)
+    yield 0.2
 
     groups = trm.vertex_groups
     for n in range(max_group + 1):
@@ -229,15 +632,22 @@ def processTRM(data, name, scale):
             groups[v[8]].add([n], v[12] / 255, 'ADD')
         if v[13] > 0:
             groups[v[9]].add([n], v[13] / 255, 'ADD')
+        if n % STEP_SIZE == STEP_SIZE - 1:
+            yield 0.2 + 0.3 * n / len(vertices)
+    yield 0.5
 
     # UV DATA
     mesh.uv_layers.new()
     uvs = mesh.uv_layers.active.data
     lps = mesh.loops
-    for p in mesh.polygons:
+    polygons = mesh.polygons
+    for p in polygons:
         for i in p.loop_indices:
             v = lps[i].vertex_index
             uvs[i].uv = (vertices[v][10] / 255, (255 - vertices[v][14]) / 255)
+        if p.index % STEP_SIZE == STEP_SIZE - 1:
+            yield 0.5 + 0.3 * p.index / len(polygons)
+    yield 0.8
 
     # MATERIALS
     # possible combinations
@@ -255,13 +665,12 @@ def processTRM(data, name, scale):
                 materials.append({'tex': t, 'shdr': s, 'sub': 'C', 'range': r, 'polys': []})
 
     # distribute polygons
-    polygons = mesh.polygons
-
     for mat in materials:
         for p in mat['range']:
             tex = textures[vertices[polygons[p].vertices[0]][6] - 1]
             if tex == mat['tex']:
                 mat['polys'].append(p)
+        yield 0.9
 
     # create & assign
     current = 0
@@ -275,8 +684,7 @@ def processTRM(data, name, scale):
 
     mesh.update()
     mesh.validate()
-
-    return trm
+    yield 1.0
 
 
 def normalByte2Float(x, y, z):
@@ -297,45 +705,126 @@ def int2rgba(i):
     return (r/255, g/255, b/255, a/255)
 
 
+# imported materials, (texture, shader[:5], sub): material name
+# only the first 5 shader values define a material, the rest are per file index ranges
+material_cache = {}
+
+# sockets store colors as 32-bit floats
+COLOR_EPSILON = 0.00001
+
+
+@persistent
+def clearCache(dummy):
+    loadMaterialCache()
+    loadMeshCache()
+
+
+# rebuild cache from imported materials in a loaded file
+def loadMaterialCache():
+    material_cache.clear()
+    for mat in bpy.data.materials:
+        key = materialKey(mat)
+        if key and key not in material_cache:
+            material_cache[key] = mat.name
+
+
+# cache key from values stored on import, None if material was renamed or its colors edited
+def materialKey(mat):
+    if 'trm_shader' not in mat or mat.get('trm_name') != mat.name:
+        return None
+    if not mat.node_tree or 'Group' not in mat.node_tree.nodes:
+        return None
+
+    shader = unpack("<5I", pack("<5i", *mat['trm_shader']))
+    inputs = mat.node_tree.nodes['Group'].inputs
+    for n in range(1, 5):
+        current = inputs['Color%d' % n].default_value
+        stored = int2rgba(shader[n])
+        for c in range(4):
+            if abs(current[c] - stored[c]) > COLOR_EPSILON:
+                return None
+
+    return (mat['trm_texture'], shader, mat['trm_sub'])
+
+
+# stored shader values are dropped once an imported material's colors are edited,
+# so exporter can use them without reading node trees
+@persistent
+def checkEditedMaterials(scene, depsgraph):
+    for update in depsgraph.updates:
+        mat = update.id.original
+        if isinstance(mat, bpy.types.Material) and 'trm_shader' in mat and not materialKey(mat):
+            del mat['trm_shader']
+
+
 def createMaterial(texture, shader, sub):
-    mat = bpy.data.materials.new(name="%d_%d_%s_Mat" % (texture, shader[0], sub))
+    key = (texture, tuple(shader[:5]), sub)
+    if key in material_cache:
+        mat = bpy.data.materials.get(material_cache[key])
+        if mat and materialKey(mat) == key:
+            return mat
+
+    mat = getTemplateMaterial().copy()
+    mat.name = "%d_%d_%s_Mat" % (texture, shader[0], sub)
+
+    group = mat.node_tree.nodes['Group']
+    group.inputs['Color1'].default_value = int2rgba(shader[1])
+    group.inputs['Color2'].default_value = int2rgba(shader[2])
+    group.inputs['Color3'].default_value = int2rgba(shader[3])
+    group.inputs['Color4'].default_value = int2rgba(shader[4])
+
+    # original values for exporter, colors stored signed to fit int properties
+    mat['trm_texture'] = texture
+    mat['trm_shader'] = unpack("<5i", pack("<5I", *shader[:5]))
+    mat['trm_sub'] = sub
+    mat['trm_name'] = mat.name
+
+    material_cache[key] = mat.name
+    return mat
+
+
+# every material is copied from this one instead of being built node by node
+def getTemplateMaterial():
+    if '.TRM_Template' in bpy.data.materials:
+        return bpy.data.materials['.TRM_Template']
+
+    mat = bpy.data.materials.new(name=".TRM_Template")
     mat.use_nodes = True
     nodes = mat.node_tree.nodes
     nodes.clear()
     main = nodes.new('ShaderNodeOutputMaterial')
 
-    if 'TRMGroup' in bpy.data.node_groups:
-        trmg = bpy.data.node_groups['TRMGroup']
-    else:
-        trmg = bpy.data.node_groups.new(name="TRMGroup", type='ShaderNodeTree')
-        trmg.interface.new_socket(name="Color1", in_out ="INPUT", socket_type="NodeSocketColor")
-        trmg.interface.new_socket(name="Color2", in_out ="INPUT", socket_type="NodeSocketColor")
-        trmg.interface.new_socket(name="Color3", in_out ="INPUT", socket_type="NodeSocketColor")
-        trmg.interface.new_socket(name="Color4", in_out ="INPUT", socket_type="NodeSocketColor")
-        trmg.interface.new_socket(name="Texture", in_out ="INPUT", socket_type="NodeSocketColor")
-        trmg.interface.new_socket(name="Surface", in_out ="OUTPUT", socket_type="NodeSocketShader")
-        inp = trmg.nodes.new('NodeGroupInput')
-        inp.location = (-100, 0)
-        out = trmg.nodes.new('NodeGroupOutput')
-        out.location = (100, 0)
-        trmg.links.new(trmg.nodes[1].inputs['Surface'], trmg.nodes[0].outputs['Texture'])
-
     group = nodes.new('ShaderNodeGroup')
     group.location = (-200, 0)
-    group.node_tree = trmg
+    group.node_tree = getTRMGroup()
     texture = nodes.new('ShaderNodeTexImage')
     texture.location = (-500, 0)
     mat.node_tree.links.new(group.inputs['Texture'], texture.outputs['Color'])
     mat.node_tree.links.new(main.inputs['Surface'], group.outputs['Surface'])
 
-    mat.node_tree.nodes['Group'].inputs['Color1'].default_value = int2rgba(shader[1])
-    mat.node_tree.nodes['Group'].inputs['Color2'].default_value = int2rgba(shader[2])
-    mat.node_tree.nodes['Group'].inputs['Color3'].default_value = int2rgba(shader[3])
-    mat.node_tree.nodes['Group'].inputs['Color4'].default_value = int2rgba(shader[4])
-
     return mat
 
 
+def getTRMGroup():
+    if 'TRMGroup' in bpy.data.node_groups:
+        return bpy.data.node_groups['TRMGroup']
+
+    trmg = bpy.data.node_groups.new(name="TRMGroup", type='ShaderNodeTree')
+    trmg.interface.new_socket(name="Color1", in_out ="INPUT", socket_type="NodeSocketColor")
+    trmg.interface.new_socket(name="Color2", in_out ="INPUT", socket_type="NodeSocketColor")
+    trmg.interface.new_socket(name="Color3", in_out ="INPUT", socket_type="NodeSocketColor")
+    trmg.interface.new_socket(name="Color4", in_out ="INPUT", socket_type="NodeSocketColor")
+    trmg.interface.new_socket(name="Texture", in_out ="INPUT", socket_type="NodeSocketColor")
+    trmg.interface.new_socket(name="Surface", in_out ="OUTPUT", socket_type="NodeSocketShader")
+    inp = trmg.nodes.new('NodeGroupInput')
+    inp.location = (-100, 0)
+    out = trmg.nodes.new('NodeGroupOutput')
+    out.location = (100, 0)
+    trmg.links.new(trmg.nodes[1].inputs['Surface'], trmg.nodes[0].outputs['Texture'])
+
+    return trmg
+
+
 def nameVertexGroups(trm, armature_type, filename):
     # possible vertex group names, 10 per line for easier counting
     joint_names = [
@@ -426,42 +915,58 @@ def processTextures(trm, textures, directory, episode):
     if trm_episode not in ['1', '2', '3']:
         trm_episode = episode
 
-    for t in textures:
-        print(f"- {t}.PNG")
-
-        png = ''
+    def findDDS(t):
         check = []
 
-        if png_path_exists:
-            check += [path.abspath(f"{png_path}/{i}/{t}.png") for i in range(int(trm_episode), 0, -1)]
         if game_path_exists:
-            check += [path.abspath(f"{game_path}/{i}/TEX/PNGs/{t}.png") for i in range(int(trm_episode), 0, -1)]
+            check += [path.abspath(f"{game_path}/{i}/TEX/{t}.DDS") for i in range(int(trm_episode), 0, -1)]
         else:
-            check += [path.abspath(path.join(directory, f"../../{i}/TEX/PNGs/{t}.png")) for i in range(int(trm_episode), 0, -1)]
+            check += [path.abspath(path.join(directory, f"../../{i}/TEX/{t}.DDS")) for i in range(int(trm_episode), 0, -1)]
 
         for f in check:
             if path.isfile(f):
-                png = f
-                break
+                return f
+        return ''
 
-        if not png:
-            if not converter_path_exists:
-                print("- ERROR: Texture Converter path must be specified in Addon Preferences!")
-                continue
+    # content addressed cache replaces PNG folders when set, read only without converter
+    cache = None
+    if prefs.cache_path:
+        cache = trm_texcache.openCache(path.abspath(prefs.cache_path))
+
+    for t in textures:
+        print(f"- {t}.PNG")
+
+        png = ''
+        cached = False
+
+        if cache:
+            dds = findDDS(t)
+            if dds:
+                png = trm_texcache.cachedPNG(cache, dds, converter_path if converter_path_exists else '')
+                cached = bool(png)
 
-            dds = ''
+        if not png:
             check = []
 
+            if png_path_exists:
+                check += [path.abspath(f"{png_path}/{i}/{t}.png") for i in range(int(trm_episode), 0, -1)]
             if game_path_exists:
-                check += [path.abspath(f"{game_path}/{i}/TEX/{t}.DDS") for i in range(int(trm_episode), 0, -1)]
+                check += [path.abspath(f"{game_path}/{i}/TEX/PNGs/{t}.png") for i in range(int(trm_episode), 0, -1)]
             else:
-                check += [path.abspath(path.join(directory, f"../../{i}/TEX/{t}.DDS")) for i in range(int(trm_episode), 0, -1)]
+                check += [path.abspath(path.join(directory, f"../../{i}/TEX/PNGs/{t}.png")) for i in range(int(trm_episode), 0, -1)]
 
             for f in check:
                 if path.isfile(f):
-                    dds = f
+                    png = f
                     break
 
+        if not png:
+            if not converter_path_exists:
+                print("- ERROR: Texture Converter path must be specified in Addon Preferences!")
+                continue
+
+            dds = findDDS(t)
+
             if not dds:
                 print("- ERROR: Source DDS could not be found!")
                 continue
@@ -484,20 +989,38 @@ def processTextures(trm, textures, directory, episode):
         if png:
             print(f"- From: {path.normpath(png)}.")
             image = bpy.data.images.load(png)
+            image.name = f"{t}.png"
+            # cached PNGs can be evicted later, keep them inside the blend file
+            if cached:
+                image.pack()
             for mat in trm.data.materials:
                 if mat.name.startswith(f"{t}_"):
                     mat.node_tree.nodes["Image Texture"].image = image
 
+    if cache:
+        trm_texcache.closeCache(cache, prefs.cache_size * 1048576)
+
     return
 
 
 def menu_func_import(self, context):
     self.layout.operator(ImportTRM.bl_idname, text="TRM / Tomb Raider I-III R (.trm)")
 
+def menu_func_finalize(self, context):
+    self.layout.operator(FinalizeTRM.bl_idname)
+
 def register():
     bpy.utils.register_class(ImportTRM)
+    bpy.utils.register_class(FinalizeTRM)
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
+    bpy.types.VIEW3D_MT_object.append(menu_func_finalize)
+    bpy.app.handlers.load_post.append(clearCache)
+    bpy.app.handlers.depsgraph_update_post.append(checkEditedMaterials)
 
 def unregister():
+    bpy.app.handlers.depsgraph_update_post.remove(checkEditedMaterials)
+    bpy.app.handlers.load_post.remove(clearCache)
+    bpy.types.VIEW3D_MT_object.remove(menu_func_finalize)
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
+    bpy.utils.unregister_class(FinalizeTRM)
     bpy.utils.unregister_class(ImportTRM)
@@ -0,0 +1,176 @@
+# v0.5.1
+
+import json
+
+from hashlib import sha1
+from time import time, sleep
+from os import path, makedirs, remove, replace, stat, listdir, getpid, write, open as osopen, close as osclose, O_CREAT, O_EXCL, O_WRONLY
+from shutil import rmtree
+from tempfile import mkdtemp
+from contextlib import contextmanager
+from subprocess import run
+
+
+# converter arguments, also part of cache keys so changing them reconverts textures
+CONVERTER_OPTIONS = ['-nologo', '-y', '-ft', 'png']
+
+# age in seconds after which a leftover index lock is considered stale
+LOCK_TIMEOUT = 60
+
+
+# PNGs converted from DDS files, stored as "[hash].png" in cache folder
+# index keeps entry sizes & last use for eviction,
+# and last known modification time, size & hash of each source DDS to skip rehashing
+def openCache(folder):
+    makedirs(folder, exist_ok=True)
+    saved = loadIndex(folder)
+
+    return {
+        'folder': folder,
+        'entries': saved['entries'],
+        'sources': saved['sources'],
+        'hits': 0,
+        'misses': 0,
+        'used': set()
+    }
+
+
+def loadIndex(folder):
+    index = path.join(folder, "index.json")
+    if path.isfile(index):
+        try:
+            with open(index, 'r') as f:
+                saved = json.load(f)
+            return {'entries': saved['entries'], 'sources': saved['sources']}
+        except (ValueError, KeyError):
+            print("- ERROR: Texture cache index is corrupt, starting over!")
+    return {'entries': {}, 'sources': {}}
+
+
+# index is shared between Blender sessions, only one may update it at a time
+# lock file holds its owner's token, so only the owner removes it
+@contextmanager
+def lockIndex(folder):
+    lock = path.join(folder, "index.lock")
+    token = "%d %f" % (getpid(), time())
+    while True:
+        try:
+            fd = osopen(lock, O_CREAT | O_EXCL | O_WRONLY)
+            write(fd, token.encode())
+            osclose(fd)
+            break
+        except FileExistsError:
+            try:
+                # lock untouched for this long, owner most likely crashed
+                if time() - path.getmtime(lock) > LOCK_TIMEOUT:
+                    remove(lock)
+                    continue
+            except FileNotFoundError:
+                continue
+            sleep(0.05)
+    try:
+        yield
+    finally:
+        try:
+            with open(lock, 'r') as f:
+                owned = f.read() == token
+            if owned:
+                remove(lock)
+        except FileNotFoundError:
+            pass
+
+
+# returns converted PNG path or empty string if conversion failed
+# without a converter only PNGs already in cache are returned
+def cachedPNG(cache, dds, converter_path):
+    folder = cache['folder']
+    info = stat(dds)
+    source = cache['sources'].get(dds)
+
+    if source and source[0] == info.st_mtime and source[1] == info.st_size:
+        key = source[2]
+    else:
+        key = hashDDS(dds)
+        cache['sources'][dds] = [info.st_mtime, info.st_size, key]
+
+    png = path.join(folder, key + ".png")
+
+    if key in cache['entries'] and path.isfile(png):
+        cache['hits'] += 1
+    else:
+        cache['misses'] += 1
+        if not converter_path:
+            return ''
+        # own folder per conversion, other sessions may convert the same name
+        temp = mkdtemp(dir=folder)
+        try:
+            run([converter_path, dds, *CONVERTER_OPTIONS, '-o', temp])
+            converted = path.join(temp, path.splitext(path.basename(dds))[0] + ".png")
+            if not path.isfile(converted):
+                print("- ERROR: Texture conversion failed!")
+                return ''
+            replace(converted, png)
+        finally:
+            rmtree(temp, ignore_errors=True)
+        cache['entries'][key] = {'size': path.getsize(png)}
+
+    cache['entries'][key]['used'] = time()
+    cache['used'].add(key)
+    return png
+
+
+def hashDDS(dds):
+    h = sha1()
+    with open(dds, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(" ".join(CONVERTER_OPTIONS).encode())
+    return h.hexdigest()
+
+
+# merge into index saved by other sessions, evict least recently used PNGs over size limit & save
+# PNGs used since the cache was opened are kept
+def closeCache(cache, limit):
+    folder = cache['folder']
+    index = path.join(folder, "index.json")
+
+    with lockIndex(folder):
+        saved = loadIndex(folder)
+        entries = saved['entries']
+        sources = saved['sources']
+
+        for key, e in cache['entries'].items():
+            if key not in entries or entries[key].get('used', 0) < e.get('used', 0):
+                entries[key] = e
+        sources.update(cache['sources'])
+
+        # PNGs missing from index still count towards size limit, aged by file time
+        for name in listdir(folder):
+            key, ext = path.splitext(name)
+            if ext == ".png" and key not in entries:
+                png = path.join(folder, name)
+                entries[key] = {'size': path.getsize(png), 'used': path.getmtime(png)}
+        for key in list(entries):
+            if not path.isfile(path.join(folder, key + ".png")):
+                del entries[key]
+
+        total = sum(e['size'] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k].get('used', 0)):
+            if total <= limit:
+                break
+            if key in cache['used']:
+                continue
+            remove(path.join(folder, key + ".png"))
+            total -= entries[key]['size']
+            del entries[key]
+
+        with open(index + ".tmp", 'w') as f:
+            json.dump({'entries': entries, 'sources': sources}, f)
+        replace(index + ".tmp", index)
+
+    cache['entries'] = entries
+    cache['sources'] = sources
+
+    lookups = cache['hits'] + cache['misses']
+    if lookups:
+        print("- Texture Cache: %d Hits, %d Misses (%d%%), %.1f MB" % (cache['hits'], cache['misses'], 100 * cache['hits'] / lookups, total / 1048576))